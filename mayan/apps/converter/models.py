@@ -86,7 +86,7 @@ class Asset(ExtraDataModelMixin, models.Model):
     def generate_image(self):
         cache_filename = '{}'.format(self.get_hash())
 
-        if self.cache_partition.get_file(filename=cache_filename):
+        if self.cache_partition.file_exists(filename=cache_filename):
             logger.debug(
                 'asset cache file "%s" found', cache_filename
             )
@@ -128,6 +128,8 @@ class Asset(ExtraDataModelMixin, models.Model):
     def get_image(self):
         with self.open() as file_object:
             image = Image.open(fp=file_object)
+            # Read the image data before the file is closed.
+            image.load()
 
             if image.mode != 'RGBA':
                 image.putalpha(alpha=255)
@@ -10,3 +10,24 @@ class AssetModelTestCase(
         self._create_test_asset()
 
         self.test_asset.get_absolute_url()
+
+    def test_asset_generate_image_method(self):
+        self._create_test_asset()
+
+        self.assertEqual(self.test_asset.cache_partition.files.count(), 0)
+
+        cache_filename = self.test_asset.generate_image()
+
+        self.assertTrue(
+            self.test_asset.cache_partition.file_exists(
+                filename=cache_filename
+            )
+        )
+
+    def test_asset_generate_image_method_cached(self):
+        self._create_test_asset()
+
+        cache_filename = self.test_asset.generate_image()
+        self.assertEqual(self.test_asset.generate_image(), cache_filename)
+
+        self.assertEqual(self.test_asset.cache_partition.files.count(), 1)
@@ -1,2 +1,6 @@
 DEFAULT_MAXIMUM_FAILED_PRUNE_ATTEMPTS = 100
 DEFAULT_MAXIMUM_NORMAL_PRUNE_ATTEMPTS = 100
+DELETE_LOCK_BATCH_SIZE = 50
+PRUNE_SCHEDULE_DELAY = 5
+PURGE_QUERYSET_CHUNK_SIZE = 1000
+STORAGE_DELETE_MAXIMUM_WORKERS = 32
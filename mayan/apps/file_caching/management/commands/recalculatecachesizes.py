@@ -0,0 +1,11 @@
+from django.core import management
+
+from ...models import Cache
+
+
+class Command(management.BaseCommand):
+    help = 'Recalculate the current size of every cache from its files.'
+
+    def handle(self, *args, **options):
+        for cache in Cache.objects.all():
+            cache.recalculate_current_size()
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Concat
+
+
+def operation_populate_full_filename(apps, schema_editor):
+    CachePartition = apps.get_model(
+        app_label='file_caching', model_name='CachePartition'
+    )
+    CachePartitionFile = apps.get_model(
+        app_label='file_caching', model_name='CachePartitionFile'
+    )
+
+    partition_name = CachePartition.objects.using(
+        schema_editor.connection.alias
+    ).filter(pk=OuterRef('partition_id')).values('name')[:1]
+
+    CachePartitionFile.objects.using(schema_editor.connection.alias).update(
+        full_filename=Concat(
+            Subquery(queryset=partition_name), Value('-'), F('filename'),
+            output_field=models.CharField()
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('file_caching', '0009_cache_current_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachepartitionfile', name='full_filename',
+            field=models.CharField(
+                db_index=True, default='', editable=False, help_text='Name '
+                'of the file in the cache storage.', max_length=384,
+                verbose_name='Full filename'
+            ), preserve_default=False
+        ),
+        migrations.RunPython(
+            code=operation_populate_full_filename,
+            reverse_code=migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,19 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('file_caching', '0010_cachepartitionfile_full_filename'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cachepartitionfile', name='file_size',
+            field=models.BigIntegerField(
+                default=0, validators=[
+                    django.core.validators.MinValueValidator(limit_value=0)
+                ], verbose_name='File size'
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('file_caching', '0011_auto_20261015_0915'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cachepartitionfile', name='hits',
+            field=models.PositiveIntegerField(
+                default=0, help_text='Times this cache partition file has '
+                'been accessed.', verbose_name='Hits'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='cachepartitionfile',
+            index=models.Index(
+                fields=['hits', 'datetime'],
+                name='file_cachin_hits_efc556_idx'
+            ),
+        ),
+    ]
@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 import logging
+import math
 
 from django.core import validators
 from django.core.files.base import ContentFile
-from django.db import models
-from django.db.models import F, Sum
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.template.defaultfilters import filesizeformat
 from django.urls import reverse
 from django.utils.encoding import force_text
@@ -27,10 +30,15 @@ from .events import (
     event_cache_purged
 )
 from .exceptions import FileCachingException
+from .literals import (
+    DELETE_LOCK_BATCH_SIZE, PRUNE_SCHEDULE_DELAY, PURGE_QUERYSET_CHUNK_SIZE,
+    STORAGE_DELETE_MAXIMUM_WORKERS
+)
 from .settings import (
     setting_maximum_failed_prune_attempts,
     setting_maximum_normal_prune_attempts
 )
+from .tasks import task_cache_prune
 
 logger = logging.getLogger(name=__name__)
 
@@ -46,6 +54,12 @@ class Cache(ValueChangeModelMixin, models.Model):
             validators.MinValueValidator(limit_value=1)
         ], verbose_name=_('Maximum size')
     )
+    current_size = models.BigIntegerField(
+        default=0, editable=False, help_text=_(
+            'Current size of the cache in bytes. Updated every time a file '
+            'is added or removed from the cache.'
+        ), verbose_name=_('Current size')
+    )
 
     class Meta:
         verbose_name = _('Cache')
@@ -54,6 +68,231 @@ class Cache(ValueChangeModelMixin, models.Model):
     def __str__(self):
         return force_text(s=self.label)
 
+    @cached_property
+    def _defined_storage(self):
+        try:
+            return DefinedStorage.get(name=self.defined_storage_name)
+        except KeyError:
+            return None
+
+    def _delete_files(self, id_list):
+        """
+        Delete the storage files and the database entries of several cache
+        partition files at once. The caller must hold the lock of each file.
+        Entries deleted by another process in the meantime are ignored.
+        Returns the total size of the files deleted.
+        """
+        file_list = list(
+            CachePartitionFile.objects.filter(
+                partition__cache_id=self.pk, pk__in=id_list
+            ).values_list('id', 'file_size', 'full_filename')
+        )
+
+        deleted_full_filename_list, storage_exception = self._delete_storage_files(
+            full_filename_list=[
+                full_filename for file_id, file_size, full_filename in file_list
+            ]
+        )
+
+        deleted_full_filename_set = set(deleted_full_filename_list)
+        deleted_id_list = []
+        deleted_file_size = 0
+
+        # Remove the entries of every file deleted from the storage, even
+        # if the deletion of others failed.
+        for file_id, file_size, full_filename in file_list:
+            if full_filename in deleted_full_filename_set:
+                deleted_id_list.append(file_id)
+                deleted_file_size += file_size
+
+        if deleted_id_list:
+            with transaction.atomic():
+                CachePartitionFile.objects.filter(
+                    pk__in=deleted_id_list
+                ).delete()
+                Cache.objects.filter(pk=self.pk).update(
+                    current_size=F('current_size') - deleted_file_size
+                )
+
+        if storage_exception is not None:
+            raise storage_exception
+
+        return deleted_file_size
+
+    def _delete_storage_files(self, full_filename_list):
+        """
+        Delete several files from the storage concurrently. Storage
+        deletions are dominated by I/O latency and not CPU. Returns the
+        list of the files deleted and the first exception raised by the
+        storage, if any.
+        """
+        deleted_full_filename_list = []
+        storage_exception = None
+
+        if len(full_filename_list) == 1:
+            try:
+                self.storage.delete(name=full_filename_list[0])
+            except Exception as exception:
+                storage_exception = exception
+            else:
+                deleted_full_filename_list.append(full_filename_list[0])
+        elif full_filename_list:
+            # Sort the names to submit the files of the same directory
+            # together.
+            with ThreadPoolExecutor(
+                max_workers=min(
+                    len(full_filename_list), STORAGE_DELETE_MAXIMUM_WORKERS
+                )
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        self.storage.delete, name=full_filename
+                    ): full_filename
+                    for full_filename in sorted(full_filename_list)
+                }
+
+                for future in as_completed(fs=futures):
+                    try:
+                        future.result()
+                    except Exception as exception:
+                        logger.error(
+                            'Unexpected exception deleting the cache file '
+                            '"%s"; %s', futures[future], exception,
+                            exc_info=True
+                        )
+                        if storage_exception is None:
+                            storage_exception = exception
+                    else:
+                        deleted_full_filename_list.append(futures[future])
+
+        return deleted_full_filename_list, storage_exception
+
+    def _lock_and_delete_files(self, lock_names):
+        """
+        Lock and delete several files. Receives a dictionary of file IDs
+        and their lock names. Files that can't be locked are skipped.
+        Returns the total size of the files deleted and the list of the
+        skipped file IDs.
+        """
+        lock_backend = LockingBackend.get_backend()
+        deleted_file_size = 0
+        lock_name_list = list(lock_names.items())
+        skipped_id_list = []
+
+        # Hold only a few locks at a time. Acquiring a lock gets slower
+        # with the number of locks held, and the first locks of a large
+        # batch could expire before their files are deleted.
+        for index in range(0, len(lock_name_list), DELETE_LOCK_BATCH_SIZE):
+            batch = lock_name_list[index:index + DELETE_LOCK_BATCH_SIZE]
+            file_locks = []
+            locked_id_list = []
+
+            try:
+                # Readers only acquire the lock of the file they are
+                # reading, the file locks are needed to not delete an open
+                # file.
+                for file_id, lock_name in batch:
+                    try:
+                        file_locks.append(
+                            lock_backend.acquire_lock(name=lock_name)
+                        )
+                    except LockError:
+                        logger.debug('unable to obtain lock: %s' % lock_name)
+                        skipped_id_list.append(file_id)
+                    else:
+                        locked_id_list.append(file_id)
+
+                deleted_file_size += self._delete_files(
+                    id_list=locked_id_list
+                )
+            finally:
+                for file_lock in file_locks:
+                    file_lock.release()
+
+        return deleted_file_size, skipped_id_list
+
+    def _prune(self):
+        failed_attempts = 0
+        normal_attempts = 0
+        skipped_id_list = []
+
+        total_size = self.get_total_size()
+
+        while total_size >= self.maximum_size:
+            normal_attempts += 1
+
+            if normal_attempts > setting_maximum_normal_prune_attempts.value:
+                raise FileCachingException(
+                    'Too many cache prunes trying to create a single new '
+                    'file.'
+                )
+
+            # Estimate how many files must be evicted from the average file
+            # size and fetch twice as many to account for size variations
+            # and locked files.
+            average_file_size = total_size / max(1, self.get_files().count())
+            batch_size = math.ceil(
+                (total_size - self.maximum_size + 1) / average_file_size
+            ) * 2
+
+            candidate_list = list(
+                self.get_files().exclude(pk__in=skipped_id_list).values_list(
+                    'id', 'partition_id', 'filename', 'file_size'
+                )[:batch_size]
+            )
+
+            if not candidate_list:
+                logger.warning(
+                    'Cache "%s" is over its maximum size but has no files '
+                    'that can be evicted.', self
+                )
+                break
+
+            lock_names = {}
+
+            for file_id, partition_id, filename, file_size in candidate_list:
+                if total_size < self.maximum_size:
+                    break
+
+                lock_names[file_id] = CachePartition.get_combined_file_lock_name(
+                    cache_id=self.pk, partition_id=partition_id,
+                    filename=filename
+                )
+                total_size -= file_size
+
+            batch_skipped_id_list = self._lock_and_delete_files(
+                lock_names=lock_names
+            )[1]
+
+            failed_attempts += len(batch_skipped_id_list)
+            skipped_id_list.extend(batch_skipped_id_list)
+
+            if failed_attempts > setting_maximum_failed_prune_attempts.value:
+                raise FileCachingException(
+                    'Too many cache prune attempts failed.'
+                )
+
+            # Files might have been skipped or other processes might have
+            # changed the cache. Refresh the actual usage.
+            total_size = self.get_total_size()
+
+    def _schedule_prune_task(self):
+        lock_name = self.get_prune_schedule_lock_name()
+        try:
+            # The lock is not released, it expires by itself when the
+            # scheduled prune executes.
+            LockingBackend.get_backend().acquire_lock(
+                name=lock_name, timeout=PRUNE_SCHEDULE_DELAY
+            )
+        except LockError:
+            logger.debug('cache %s prune already scheduled', self)
+        else:
+            task_cache_prune.apply_async(
+                countdown=PRUNE_SCHEDULE_DELAY, kwargs={
+                    'cache_id': self.pk
+                }
+            )
+
     def get_absolute_url(self):
         return reverse(
             viewname='file_caching:cache_detail', kwargs={
@@ -62,7 +301,12 @@ class Cache(ValueChangeModelMixin, models.Model):
         )
 
     def get_files(self):
-        return CachePartitionFile.objects.filter(partition__cache__id=self.pk)
+        """
+        Return the files of the cache in eviction order.
+        """
+        return CachePartitionFile.objects.filter(
+            partition__cache_id=self.pk
+        ).order_by('hits', 'datetime')
 
     def get_maximum_size_display(self):
         return filesizeformat(bytes_=self.maximum_size)
@@ -73,25 +317,38 @@ class Cache(ValueChangeModelMixin, models.Model):
     get_maximum_size_display.short_description = _('Maximum size')
 
     def get_defined_storage(self):
-        try:
-            return DefinedStorage.get(name=self.defined_storage_name)
-        except KeyError:
+        if self._defined_storage is not None:
+            return self._defined_storage
+        else:
             return DefinedStorage(
                 dotted_path='', label=_('Unknown'), name='unknown'
             )
 
+    def get_prune_lock_name(self):
+        return 'cache-prune-{}'.format(self.pk)
+
+    def get_prune_schedule_lock_name(self):
+        return 'cache-prune-schedule-{}'.format(self.pk)
+
     def get_total_size(self):
         """
         Return the actual usage of the cache.
         """
-        return self.get_files().aggregate(
-            file_size__sum=Sum('file_size')
-        )['file_size__sum'] or 0
+        self.refresh_from_db(fields=('current_size',))
+        return self.current_size
 
     def get_total_size_display(self):
+        # Use the size loaded with the instance instead of calling
+        # .get_total_size() to avoid a query per cache when listing caches.
+        total_size = self.current_size
+
+        if total_size:
+            percent = total_size / self.maximum_size * 100
+        else:
+            percent = 0
+
         return format_lazy(
-            '{} ({:0.1f}%)', filesizeformat(bytes_=self.get_total_size()),
-            self.get_total_size() / self.maximum_size * 100
+            '{} ({:0.1f}%)', filesizeformat(bytes_=total_size), percent
         )
 
     get_total_size_display.short_description = _('Current size')
@@ -104,51 +361,48 @@ class Cache(ValueChangeModelMixin, models.Model):
     def prune(self):
         """
         Deletes files until the total size of the cache is below the allowed
-        maximum size of the cache.
+        maximum size of the cache. Only one process prunes a cache at a
+        time, if the cache is already being pruned this method returns
+        without waiting.
         """
-        failed_attempts = 0
-        normal_attempts = 0
-        file_index = 0
-
-        while self.get_total_size() >= self.maximum_size:
-            cache_partition_file_queryset = self.get_files().order_by(
-                'hits', 'datetime'
+        lock_name = self.get_prune_lock_name()
+        try:
+            logger.debug('trying to acquire lock: %s', lock_name)
+            lock = LockingBackend.get_backend().acquire_lock(name=lock_name)
+            logger.debug('acquired lock: %s', lock_name)
+        except LockError:
+            logger.debug(
+                'unable to obtain lock: %s; cache is already being pruned',
+                lock_name
             )
-
+        else:
             try:
-                cache_partition_file = cache_partition_file_queryset[file_index]
-            except IndexError:
-                # Attempted to get a file beyond what the queryset provided.
-                file_index = 0
-            else:
-                try:
-                    cache_partition_file.delete()
-                except CachePartitionFile.DoesNotExist:
-                    # The file selected from deletion was deleted by another
-                    # process before the lock was acquired.
-                    file_index += 1
-                except LockError:
-                    logger.debug(
-                        'Lock error trying to delete file "%s" for prune. '
-                        'Skipping and attempting next file.',
-                        cache_partition_file
-                    )
-                    failed_attempts += 1
-                    file_index += 1
-
-                    if failed_attempts > setting_maximum_failed_prune_attempts.value:
-                        raise FileCachingException(
-                            'Too many cache prune attempts failed.'
-                        )
-                else:
-                    file_index = 0
-                    normal_attempts += 1
+                self._prune()
+            finally:
+                lock.release()
 
-                    if normal_attempts > setting_maximum_normal_prune_attempts.value:
-                        raise FileCachingException(
-                            'Too many cache prunes trying to create a '
-                            'single new file.'
-                        )
+    def recalculate_current_size(self):
+        """
+        Recalculate the current size counter from the size of the cache
+        files. Used to repair the counter if it ever drifts.
+        """
+        file_size_sum = CachePartitionFile.objects.filter(
+            partition__cache_id=OuterRef('pk')
+        ).order_by().values('partition__cache_id').annotate(
+            file_size__sum=Sum('file_size')
+        ).values('file_size__sum')
+
+        # Compute and store the sum in a single query to not lose the
+        # concurrent updates of the counter.
+        Cache.objects.filter(pk=self.pk).update(
+            current_size=Coalesce(
+                Subquery(
+                    queryset=file_size_sum,
+                    output_field=models.BigIntegerField()
+                ), Value(0)
+            )
+        )
+        self.refresh_from_db(fields=('current_size',))
 
     @method_event(
         event=event_cache_purged,
@@ -159,18 +413,66 @@ class Cache(ValueChangeModelMixin, models.Model):
         """
         Deletes the entire cache.
         """
-        try:
-            DefinedStorage.get(name=self.defined_storage_name)
-        except KeyError:
+        if self._defined_storage is None:
             """
             Unknown or deleted storage. Must not be purged otherwise only
             the database data will be erased but the actual storage files
             will remain.
             """
         else:
-            for partition in self.partitions.all():
-                partition._event_actor = getattr(self, '_event_actor', None)
-                partition.purge()
+            partitions = self.partitions.in_bulk()
+            lock_names = {}
+            skipped_id_list = []
+
+            queryset = CachePartitionFile.objects.filter(
+                partition__cache_id=self.pk
+            ).values_list('id', 'partition_id', 'filename').iterator(
+                chunk_size=PURGE_QUERYSET_CHUNK_SIZE
+            )
+
+            for file_id, partition_id, filename in queryset:
+                # Build the lock name from the row, the file might belong
+                # to a partition created after the partitions were loaded.
+                lock_names[file_id] = CachePartition.get_combined_file_lock_name(
+                    cache_id=self.pk, partition_id=partition_id,
+                    filename=filename
+                )
+
+                if len(lock_names) >= PURGE_QUERYSET_CHUNK_SIZE:
+                    skipped_id_list.extend(
+                        self._lock_and_delete_files(lock_names=lock_names)[1]
+                    )
+                    lock_names = {}
+
+            if lock_names:
+                skipped_id_list.extend(
+                    self._lock_and_delete_files(lock_names=lock_names)[1]
+                )
+
+            if skipped_id_list:
+                skipped_partition_id_set = set(
+                    CachePartitionFile.objects.filter(
+                        pk__in=skipped_id_list
+                    ).values_list('partition_id', flat=True)
+                )
+            else:
+                skipped_partition_id_set = set()
+
+            # Partitions with files that could not be deleted are not
+            # purged.
+            for partition_id, partition in partitions.items():
+                if partition_id not in skipped_partition_id_set:
+                    event_cache_partition_purged.commit(
+                        actor=getattr(self, '_event_actor', None),
+                        target=partition
+                    )
+
+            if skipped_id_list:
+                raise LockError(
+                    'Unable to lock {} files of the cache.'.format(
+                        len(skipped_id_list)
+                    )
+                )
 
     @method_event(
         event_manager_class=EventManagerSave,
@@ -184,17 +486,39 @@ class Cache(ValueChangeModelMixin, models.Model):
         }
     )
     def save(self, *args, **kwargs):
+        is_new = self._state.adding
+
         old_maximum_size = self._get_field_previous_value(
             field='maximum_size'
         )
 
+        if not is_new and 'update_fields' not in kwargs:
+            # The current size is updated atomically by the cache files.
+            # Don't overwrite it with the value loaded by this instance.
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields if (
+                    not field.primary_key and field.name != 'current_size'
+                )
+            ]
+
         result = super().save(*args, **kwargs)
 
-        if self.maximum_size < old_maximum_size:
-            self.prune()
+        # New caches are empty and don't need pruning.
+        if not is_new and self.maximum_size < old_maximum_size:
+            self.schedule_prune()
 
         return result
 
+    def schedule_prune(self):
+        """
+        Prune the cache in the background after the current transaction
+        commits. Requests made while a prune is already scheduled are
+        ignored so that rapid writes result in a single prune.
+        """
+        # Take the schedule lock only when the transaction commits, a
+        # rolled back transaction must not block the following requests.
+        transaction.on_commit(func=self._schedule_prune_task)
+
     @cached_property
     def storage(self):
         return self.get_defined_storage().get_storage_instance()
@@ -214,6 +538,12 @@ class CachePartition(models.Model):
         verbose_name = _('Cache partition')
         verbose_name_plural = _('Cache partitions')
 
+    @staticmethod
+    def get_combined_file_lock_name(cache_id, partition_id, filename):
+        return 'cache_partition-file-{}-{}-{}'.format(
+            cache_id, partition_id, filename
+        )
+
     @staticmethod
     def get_combined_filename(parent, filename):
         return '{}-{}'.format(parent, filename)
@@ -223,14 +553,15 @@ class CachePartition(models.Model):
 
     @contextmanager
     def create_file(self, filename):
+        # Writers are not held back by the eviction of unrelated files.
+        self.cache.schedule_prune()
+
         lock_name = self.get_file_lock_name(filename=filename)
         try:
             logger.debug('trying to acquire lock: %s', lock_name)
             lock = LockingBackend.get_backend().acquire_lock(name=lock_name)
             logger.debug('acquired lock: %s', lock_name)
             try:
-                self.cache.prune()
-
                 # Since open "wb+" doesn't create files, force the creation
                 # of an empty file.
                 self.cache.storage.delete(
@@ -270,16 +601,41 @@ class CachePartition(models.Model):
             logger.debug('unable to obtain lock: %s' % lock_name)
             raise
 
+    def bulk_delete_files(self, id_list):
+        """
+        Delete several files of the partition at once. The files are
+        removed with a single query. Files opened by other processes are
+        skipped. Returns the total size of the files deleted and the list
+        of the skipped file IDs.
+        """
+        queryset = self.files.filter(pk__in=id_list).values_list(
+            'id', 'filename'
+        )
+
+        return self.cache._lock_and_delete_files(
+            lock_names={
+                file_id: self.get_file_lock_name(filename=filename)
+                for file_id, filename in queryset
+            }
+        )
+
     def delete(self, *args, **kwargs):
         self.purge()
         return super().delete(*args, **kwargs)
 
+    def file_exists(self, filename):
+        """
+        Check if the partition has an entry for the file. Only performs an
+        index lookup in the database, the storage is not checked.
+        """
+        return self.files.filter(filename=filename).exists()
+
     def get_file(self, filename):
         return self.files.get(filename=filename)
 
     def get_file_lock_name(self, filename):
-        return 'cache_partition-file-{}-{}-{}'.format(
-            self.cache.pk, self.pk, filename
+        return CachePartition.get_combined_file_lock_name(
+            cache_id=self.cache_id, partition_id=self.pk, filename=filename
         )
 
     def get_full_filename(self, filename):
@@ -293,8 +649,33 @@ class CachePartition(models.Model):
         target='self'
     )
     def purge(self):
-        for parition_file in self.files.all():
-            parition_file.delete()
+        id_list = []
+        skipped_id_list = []
+
+        queryset = self.files.values_list('id', flat=True).iterator(
+            chunk_size=PURGE_QUERYSET_CHUNK_SIZE
+        )
+
+        for file_id in queryset:
+            id_list.append(file_id)
+
+            if len(id_list) >= PURGE_QUERYSET_CHUNK_SIZE:
+                skipped_id_list.extend(
+                    self.bulk_delete_files(id_list=id_list)[1]
+                )
+                id_list = []
+
+        if id_list:
+            skipped_id_list.extend(
+                self.bulk_delete_files(id_list=id_list)[1]
+            )
+
+        if skipped_id_list:
+            raise LockError(
+                'Unable to lock {} files of the cache partition.'.format(
+                    len(skipped_id_list)
+                )
+            )
 
 
 class CachePartitionFile(models.Model):
@@ -308,17 +689,27 @@ class CachePartitionFile(models.Model):
         auto_now_add=True, db_index=True, verbose_name=_('Date time')
     )
     filename = models.CharField(max_length=255, verbose_name=_('Filename'))
-    file_size = models.PositiveIntegerField(
-        default=0, verbose_name=_('File size')
+    full_filename = models.CharField(
+        db_index=True, editable=False, help_text=_(
+            'Name of the file in the cache storage.'
+        ), max_length=384, verbose_name=_('Full filename')
+    )
+    file_size = models.BigIntegerField(
+        default=0, validators=[
+            validators.MinValueValidator(limit_value=0)
+        ], verbose_name=_('File size')
     )
     hits = models.PositiveIntegerField(
-        db_index=True, default=0, help_text=_(
+        default=0, help_text=_(
             'Times this cache partition file has been accessed.'
         ), verbose_name='Hits'
     )
 
     class Meta:
         get_latest_by = 'datetime'
+        indexes = (
+            models.Index(fields=('hits', 'datetime')),
+        )
         unique_together = ('partition', 'filename')
         verbose_name = _('Cache partition file')
         verbose_name_plural = _('Cache partition files')
@@ -349,14 +740,21 @@ class CachePartitionFile(models.Model):
         """
         Called after creation and initial write only.
         """
-        self.file_size = self.partition.cache.storage.size(
+        file_size = self.partition.cache.storage.size(
             name=self.full_filename
         )
-        self.save()
+
+        with transaction.atomic():
+            Cache.objects.filter(pk=self.partition.cache_id).update(
+                current_size=F('current_size') + file_size - self.file_size
+            )
+            self.file_size = file_size
+            self.save(update_fields=('file_size',))
+
         if self.file_size > self.partition.cache.maximum_size:
             raise FileCachingException(
-                'Cache partition file %s is bigger than the maximum cache '
-                'size.'
+                'Cache partition file {} is bigger than the maximum cache '
+                'size.'.format(self.full_filename)
             )
 
     @release_lock_class_method
@@ -368,13 +766,17 @@ class CachePartitionFile(models.Model):
     @locked_class_method
     def delete(self, *args, **kwargs):
         self.partition.cache.storage.delete(name=self.full_filename)
-        return super().delete(*args, **kwargs)
 
-    @cached_property
-    def full_filename(self):
-        return CachePartition.get_combined_filename(
-            parent=self.partition.name, filename=self.filename
-        )
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+
+            deleted_count, deleted_detail = result
+            if deleted_count:
+                Cache.objects.filter(pk=self.partition.cache_id).update(
+                    current_size=F('current_size') - self.file_size
+                )
+
+        return result
 
     @contextmanager
     def open(self):
@@ -407,3 +809,9 @@ class CachePartitionFile(models.Model):
         except LockError:
             logger.debug('unable to obtain lock: %s' % lock_name)
             raise
+
+    def save(self, *args, **kwargs):
+        self.full_filename = self.partition.get_full_filename(
+            filename=self.filename
+        )
+        return super().save(*args, **kwargs)
@@ -47,6 +47,19 @@ def task_cache_partition_purge(
         logger.info('Finished cache partition id %s purge', cache_partition)
 
 
+@app.task(ignore_result=True)
+def task_cache_prune(cache_id):
+    Cache = apps.get_model(
+        app_label='file_caching', model_name='Cache'
+    )
+
+    cache = Cache.objects.get(pk=cache_id)
+
+    logger.info('Starting cache id %s prune', cache)
+    cache.prune()
+    logger.info('Finished cache id %s prune', cache)
+
+
 @app.task(bind=True, ignore_result=True)
 def task_cache_purge(self, cache_id, user_id=None):
     Cache = apps.get_model(
@@ -1,10 +1,13 @@
 from django.utils.encoding import force_bytes
 
+from mayan.apps.lock_manager.backends.base import LockingBackend
 from mayan.apps.storage.classes import DefinedStorage
 from mayan.apps.storage.utils import fs_cleanup, mkdtemp
 
 from ..models import Cache
-from ..tasks import task_cache_partition_purge, task_cache_purge
+from ..tasks import (
+    task_cache_partition_purge, task_cache_prune, task_cache_purge
+)
 
 from .literals import (
     TEST_CACHE_MAXIMUM_SIZE, TEST_CACHE_PARTITION_FILE_FILENAME,
@@ -32,6 +35,8 @@ class CacheTestMixin:
             kwargs={'location': self.temporary_directory}
         )
         self.test_cache_partition_files = []
+        # Remove prune schedule locks left by previous tests.
+        LockingBackend.get_backend().purge_locks()
 
     def tearDown(self):
         fs_cleanup(filename=self.temporary_directory)
@@ -107,6 +112,13 @@ class FileCachingTaskTestMixin:
             }
         ).get()
 
+    def _execute_task_cache_prune(self):
+        task_cache_prune.apply_async(
+            kwargs={
+                'cache_id': self.test_cache.pk
+            }
+        ).get()
+
     def _execute_task_cache_purge(self):
         task_cache_purge.apply_async(
             kwargs={
@@ -1,6 +1,9 @@
+from mayan.apps.lock_manager.exceptions import LockError
 from mayan.apps.testing.tests.base import BaseTestCase
 
-from ..events import event_cache_created, event_cache_purged
+from ..events import (
+    event_cache_created, event_cache_partition_purged, event_cache_purged
+)
 from ..models import Cache
 
 from .mixins import CacheTestMixin
@@ -38,3 +41,30 @@ class CacheEventsTestCase(CacheTestMixin, BaseTestCase):
         self.assertEqual(events[0].actor, cache)
         self.assertEqual(events[0].target, cache)
         self.assertEqual(events[0].verb, event_cache_purged.id)
+
+    def test_cache_purge_locked_file_partition_event(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+
+        test_cache_partition_locked = self.test_cache_partition
+        self.test_cache_partition = self.test_cache.partitions.create(
+            name='test_cache_partition_unlocked'
+        )
+        self._create_test_cache_partition_file()
+
+        self._clear_events()
+
+        with self.test_cache_partition_files[0].open():
+            with self.assertRaises(expected_exception=LockError):
+                self.test_cache.purge()
+
+        events = self._get_test_events()
+        self.assertEqual(events.count(), 1)
+
+        self.assertEqual(events[0].action_object, None)
+        self.assertEqual(events[0].target, self.test_cache_partition)
+        self.assertEqual(events[0].verb, event_cache_partition_purged.id)
+        self.assertNotEqual(
+            test_cache_partition_locked, self.test_cache_partition
+        )
@@ -1,9 +1,16 @@
 import mock
 
-from mayan.apps.testing.tests.base import BaseTestCase
+from django.db import transaction
+from django.template.defaultfilters import filesizeformat
+
+from mayan.apps.lock_manager.backends.base import LockingBackend
+from mayan.apps.lock_manager.exceptions import LockError
+from mayan.apps.testing.tests.base import (
+    BaseTestCase, BaseTransactionTestCase
+)
 
 from ..exceptions import FileCachingException
-from ..models import CachePartitionFile
+from ..models import Cache, CachePartitionFile
 
 from .literals import TEST_CACHE_PARTITION_FILE_FILENAME
 from .mixins import CacheTestMixin
@@ -32,6 +39,123 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
 
         self.assertNotEqual(cache_total_size, self.test_cache.get_total_size())
 
+    def test_cache_partition_purge(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+        self._create_test_cache_partition_file()
+
+        self.test_cache_partition.purge()
+
+        self.assertEqual(self.test_cache_partition.files.count(), 0)
+        self.assertEqual(self.test_cache.get_total_size(), 0)
+        for cache_partition_file in self.test_cache_partition_files:
+            self.assertFalse(
+                self.test_cache.storage.exists(
+                    name=cache_partition_file.full_filename
+                )
+            )
+
+    def test_cache_partition_bulk_delete_files(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=1)
+        self._create_test_cache_partition_file(file_size=2)
+
+        with self.test_cache_partition_files[0].open():
+            deleted_file_size, skipped_id_list = self.test_cache_partition.bulk_delete_files(
+                id_list=[
+                    cache_partition_file.pk for cache_partition_file in self.test_cache_partition_files
+                ]
+            )
+
+        self.assertEqual(deleted_file_size, 2)
+        self.assertEqual(
+            skipped_id_list, [self.test_cache_partition_files[0].pk]
+        )
+        self.assertEqual(self.test_cache_partition.files.count(), 1)
+        self.assertEqual(self.test_cache.get_total_size(), 1)
+
+    def test_cache_partition_purge_locked_file(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+
+        with self.test_cache_partition_file.open():
+            with self.assertRaises(expected_exception=LockError):
+                self.test_cache_partition.purge()
+
+        self.assertEqual(self.test_cache_partition.files.count(), 1)
+
+    @mock.patch(
+        'mayan.apps.file_caching.models.DELETE_LOCK_BATCH_SIZE', new=1
+    )
+    def test_cache_purge_lock_batches(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+        self._create_test_cache_partition_file()
+        self._create_test_cache_partition_file()
+
+        with self.test_cache_partition_files[1].open():
+            with self.assertRaises(expected_exception=LockError):
+                self.test_cache.purge()
+
+        self.assertEqual(
+            list(self.test_cache.get_files()),
+            [self.test_cache_partition_files[1]]
+        )
+
+    def test_cache_purge_new_partition(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+
+        # Simulate a partition created after the partitions were loaded.
+        with mock.patch('django.db.models.query.QuerySet.in_bulk') as mock_in_bulk:
+            mock_in_bulk.return_value = {}
+            self.test_cache.purge()
+
+        self.assertEqual(self.test_cache.get_files().count(), 0)
+
+    def test_cache_purge_storage_error(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=1)
+        self._create_test_cache_partition_file(file_size=2)
+        self._create_test_cache_partition_file(file_size=4)
+
+        storage_delete = self.test_cache.storage.delete
+        failing_full_filename = self.test_cache_partition_files[1].full_filename
+
+        def mock_storage_delete(name):
+            if name == failing_full_filename:
+                raise IOError
+            storage_delete(name=name)
+
+        with mock.patch.object(
+            self.test_cache.storage, 'delete', side_effect=mock_storage_delete
+        ):
+            with self.assertRaises(expected_exception=IOError):
+                self.test_cache.purge()
+
+        self.assertEqual(
+            list(self.test_cache.get_files()),
+            [self.test_cache_partition_files[1]]
+        )
+        self.assertEqual(self.test_cache.get_total_size(), 2)
+
+    def test_cache_purge_locked_file(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+
+        with self.test_cache_partition_file.open():
+            with self.assertRaises(expected_exception=LockError):
+                self.test_cache.purge()
+
+        self.assertEqual(self.test_cache.get_files().count(), 1)
+
     @mock.patch('django.core.files.File.close')
     def test_storage_file_close(self, mock_storage_file_close_method):
         self._create_test_cache()
@@ -91,6 +215,26 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
             )
         )
 
+    def test_cache_partition_file_exists(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+
+        self.assertFalse(
+            self.test_cache_partition.file_exists(
+                filename=TEST_CACHE_PARTITION_FILE_FILENAME
+            )
+        )
+
+        self._create_test_cache_partition_file(
+            filename=TEST_CACHE_PARTITION_FILE_FILENAME
+        )
+
+        self.assertTrue(
+            self.test_cache_partition.file_exists(
+                filename=TEST_CACHE_PARTITION_FILE_FILENAME
+            )
+        )
+
     def test_cache_partition_file_hits(self):
         self._create_test_cache()
         self._create_test_cache_partition()
@@ -107,6 +251,23 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
             self.test_cache_partition_file.hits, cache_partition_file_hits + 1
         )
 
+    def test_cache_partition_file_full_filename(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+
+        self.assertEqual(
+            self.test_cache_partition_file.full_filename,
+            self.test_cache_partition.get_full_filename(
+                filename=self.test_cache_partition_file.filename
+            )
+        )
+        self.assertTrue(
+            self.test_cache.storage.exists(
+                name=self.test_cache_partition_file.full_filename
+            )
+        )
+
     def test_cache_partition_file_lru_eviction(self):
         self._create_test_cache(
             extra_data={
@@ -121,6 +282,9 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
         with self.test_cache_partition_files[0].open():
             """Do nothing"""
 
+        # Test case transactions are not committed, execute the prune
+        # that the new file would schedule.
+        self.test_cache.prune()
         self._create_test_cache_partition_file(file_size=1)
 
         # Older but more hits was kept.
@@ -144,21 +308,119 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
         with self.assertRaises(expected_exception=FileCachingException):
             self._create_test_cache_partition_file(file_size=2)
 
-    @mock.patch('mayan.apps.file_caching.models.Cache.prune')
-    def test_prune_on_cache_size_reduction(self, mock_cache_prune_method):
+    def test_cache_current_size_tracking(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=2)
+        self._create_test_cache_partition_file(file_size=3)
+
+        self.assertEqual(self.test_cache.get_total_size(), 5)
+
+        self.test_cache_partition_files[0].delete()
+
+        self.assertEqual(self.test_cache.get_total_size(), 3)
+
+    def test_cache_get_total_size_display(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=2)
+
+        test_cache = Cache.objects.get(pk=self.test_cache.pk)
+
+        with self.assertNumQueries(num=0):
+            self.assertEqual(
+                str(test_cache.get_total_size_display()),
+                '{} ({:0.1f}%)'.format(
+                    filesizeformat(bytes_=2),
+                    2 / test_cache.maximum_size * 100
+                )
+            )
+
+    def test_cache_recalculate_current_size(self):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=2)
+
+        Cache.objects.filter(pk=self.test_cache.pk).update(current_size=0)
+
+        self.test_cache.recalculate_current_size()
+
+        self.assertEqual(self.test_cache.get_total_size(), 2)
+
+    def test_cache_recalculate_current_size_empty(self):
+        self._create_test_cache()
+
+        Cache.objects.filter(pk=self.test_cache.pk).update(current_size=2)
+
+        self.test_cache.recalculate_current_size()
+
+        self.assertEqual(self.test_cache.current_size, 0)
+
+    def test_cache_prune_multiple_files(self):
+        self._create_test_cache(
+            extra_data={
+                'maximum_size': 4
+            }
+        )
+
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=1)
+        self._create_test_cache_partition_file(file_size=1)
+        self._create_test_cache_partition_file(file_size=1)
+
+        self.test_cache.maximum_size = 2
+        self.test_cache.save()
+        self.test_cache.prune()
+
+        self.assertEqual(self.test_cache.get_files().count(), 1)
+        self.assertEqual(self.test_cache.get_total_size(), 1)
+        # Oldest files are evicted first.
+        self.assertTrue(
+            self.test_cache_partition_files[2] in CachePartitionFile.objects.all()
+        )
+
+    def test_cache_prune_locked(self):
         self._create_test_cache(
             extra_data={
                 'maximum_size': 2
             }
         )
 
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file(file_size=1)
+        self._create_test_cache_partition_file(file_size=1)
+
+        lock = LockingBackend.get_backend().acquire_lock(
+            name=self.test_cache.get_prune_lock_name()
+        )
+
+        try:
+            self.test_cache.prune()
+        finally:
+            lock.release()
+
+        self.assertEqual(self.test_cache.get_files().count(), 2)
+
+        self.test_cache.prune()
+
+        self.assertEqual(self.test_cache.get_files().count(), 1)
+
+    @mock.patch('mayan.apps.file_caching.models.Cache.schedule_prune')
+    def test_prune_on_cache_size_reduction(self, mock_cache_schedule_prune_method):
+        self._create_test_cache(
+            extra_data={
+                'maximum_size': 2
+            }
+        )
+        mock_cache_schedule_prune_method.reset_mock()
+
         self.test_cache.maximum_size = 2
         self.test_cache.save()
-        self.assertFalse(mock_cache_prune_method.called)
+        self.assertFalse(mock_cache_schedule_prune_method.called)
 
         self.test_cache.maximum_size = 1
         self.test_cache.save()
-        self.assertTrue(mock_cache_prune_method.called)
+        self.assertTrue(mock_cache_schedule_prune_method.called)
 
     def test_incremental_file_index_cache_prune(self):
         self._create_test_cache(
@@ -176,6 +438,7 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
 
         with self.test_cache_partition_files[0].open():
             """Lock and increase hits of file #0"""
+            self.test_cache.prune()
             self._create_test_cache_partition_file(file_size=1)
 
         self.assertTrue(
@@ -187,3 +450,34 @@ class CacheModelTestCase(CacheTestMixin, BaseTestCase):
         self.assertTrue(
             self.test_cache_partition_files[2] in CachePartitionFile.objects.all()
         )
+
+
+class CacheModelTransactionTestCase(CacheTestMixin, BaseTransactionTestCase):
+    """
+    Use a transaction test case to test the transaction.on_commit code
+    that schedules the cache prune task.
+    """
+
+    @mock.patch('mayan.apps.file_caching.models.Cache.prune')
+    def test_prune_schedule_debounce(self, mock_cache_prune_method):
+        self._create_test_cache()
+        self._create_test_cache_partition()
+        self._create_test_cache_partition_file()
+        self._create_test_cache_partition_file()
+
+        self.assertEqual(mock_cache_prune_method.call_count, 1)
+
+    @mock.patch('mayan.apps.file_caching.models.Cache.prune')
+    def test_prune_schedule_rollback(self, mock_cache_prune_method):
+        self._create_test_cache()
+
+        try:
+            with transaction.atomic():
+                self.test_cache.schedule_prune()
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.test_cache.schedule_prune()
+
+        self.assertEqual(mock_cache_prune_method.call_count, 1)
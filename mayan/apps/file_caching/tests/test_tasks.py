@@ -29,6 +29,15 @@ class FileCachingTaskTestCase(
         self.assertEqual(events[0].target, self.test_cache_partition)
         self.assertEqual(events[0].verb, event_cache_partition_purged.id)
 
+    def test_task_cache_prune(self):
+        self.test_cache.maximum_size = 1
+        self.test_cache.save()
+
+        self._execute_task_cache_prune()
+
+        self.assertEqual(self.test_cache_partition.files.count(), 0)
+        self.assertEqual(self.test_cache.get_total_size(), 0)
+
     def test_task_cache_purge(self):
         self._clear_events()
 